@@ -0,0 +1,191 @@
+"""
+Construcción del Forest Plot con Plotly.
+
+Implementación canónica de `generate_plotly_forest_plot`, compartida por la
+app de Streamlit (antes había dos copias casi idénticas del mismo código).
+"""
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+
+
+# Umbrales para datasets grandes (ej. meta-análisis con miles de estudios)
+LARGE_PLOT_THRESHOLD = 1000   # por encima, anotaciones espaciadas
+DOWNSAMPLE_THRESHOLD = 50000  # por encima, muestrear filas antes de dibujar
+
+
+def generate_plotly_forest_plot(df, title, ref_line_value, x_axis_label, plot_colors, annot_step=None):
+    """
+    Genera un Forest Plot interactivo usando Plotly.
+
+    Convierte los datos a tuplas hasheables y delega en `build_fig`, que está
+    cacheada: si ningún dato ni opción cambió, la figura no se reconstruye.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas 'label', 'value', 'lower_ci', 'upper_ci'.
+        title (str): Título principal del gráfico.
+        ref_line_value (float): Valor para la línea de referencia (ej. 0 o 1).
+        x_axis_label (str): Etiqueta del eje X.
+        plot_colors (dict): Diccionario con colores para 'marker', 'ci_line', 'ref_line'.
+        annot_step (int | None): Anotar solo 1 de cada `annot_step` filas
+            (None = automático según el tamaño del dataset).
+
+    Returns:
+        plotly.graph_objects.Figure: Objeto figura de Plotly.
+    """
+    return build_fig(
+        tuple(df['label']),
+        tuple(df['value']),
+        tuple(df['lower_ci']),
+        tuple(df['upper_ci']),
+        title,
+        ref_line_value,
+        x_axis_label,
+        tuple(sorted(plot_colors.items())),
+        annot_step
+    )
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def build_fig(labels_key, values_key, lower_key, upper_key, title, ref_line_value, x_axis_label, colors_key, annot_step=None):
+    """
+    Construye la figura a partir de claves hasheables (tuplas). Cacheada con
+    st.cache_resource para reutilizar la misma figura entre reruns.
+    """
+    plot_colors = dict(colors_key)
+
+    # Invertir el orden para que el primer estudio quede arriba en el gráfico.
+    # El slicing [::-1] de NumPy devuelve una vista, sin copiar el DataFrame.
+    val = np.asarray(values_key, dtype=float)[::-1]
+    lo = np.asarray(lower_key, dtype=float)[::-1]
+    hi = np.asarray(upper_key, dtype=float)[::-1]
+    labels = np.asarray(labels_key)[::-1]
+
+    n = val.size
+    if n > DOWNSAMPLE_THRESHOLD:
+        # Más puntos de los que el navegador puede dibujar con fluidez:
+        # muestreo regular hasta ~5000 filas
+        step = n // 5000
+        val, lo, hi, labels = val[::step], lo[::step], hi[::step], labels[::step]
+        n = val.size
+
+    # Eje Y como categoría ordenada precalculada: plotly.js recibe el orden
+    # ya resuelto y no tiene que deducir ni ordenar categorías comparando
+    # strings. Los arrays NumPy se pasan tal cual (se serializan más rápido
+    # que las listas de Python).
+    label_cat = pd.Categorical(labels, categories=pd.unique(labels), ordered=True)
+    y_categories = label_cat.categories.to_numpy()
+
+    # Rango del eje X: incluye la línea de referencia y deja espacio a la
+    # derecha para el texto con los valores numéricos
+    effective_min_x = min(lo.min(), ref_line_value)
+    effective_max_x = max(hi.max(), ref_line_value)
+    padding_factor = 0.20 # 20% del rango de los datos para el texto
+    calculated_x_range_max = effective_max_x + (effective_max_x - effective_min_x) * padding_factor
+    calculated_x_range_min = effective_min_x - (effective_max_x - effective_min_x) * padding_factor * 0.1 # Pequeño padding a la izquierda
+
+    # Barras de CI como una única traza de segmentos (lo_i -> hi_i en la
+    # fila i), separados por NaN: una sola llamada de dibujo en lugar de las
+    # N sub-líneas que genera error_x por punto
+    x_ci = np.empty(3 * n)
+    x_ci[0::3] = lo
+    x_ci[1::3] = hi
+    x_ci[2::3] = np.nan # separador entre segmentos
+    y_ci = np.repeat(labels, 3)
+
+    # Valores numéricos exactos como una única traza de texto
+    # (una traza con N puntos en lugar de N anotaciones individuales)
+    if annot_step is None:
+        # Automático: anotar todas las filas en gráficos pequeños y ~200
+        # filas repartidas en gráficos grandes
+        annot_step = max(1, n // 200) if n > LARGE_PLOT_THRESHOLD else 1
+    ann_val, ann_lo, ann_hi = val[::annot_step], lo[::annot_step], hi[::annot_step]
+    # Formato "v.vv [l.ll, u.uu]" vectorizado con numpy.char (bucles en C,
+    # sin un f-string de Python por fila)
+    ann_text = np.char.add(np.char.mod('%.2f', ann_val), ' [')
+    ann_text = np.char.add(ann_text, np.char.mod('%.2f', ann_lo))
+    ann_text = np.char.add(ann_text, ', ')
+    ann_text = np.char.add(ann_text, np.char.mod('%.2f', ann_hi))
+    ann_text = np.char.add(ann_text, ']')
+
+    data_list = [
+        # Barras de CI (debajo, para que los puntos queden encima)
+        {
+            "type": "scattergl",
+            "x": x_ci,
+            "y": y_ci,
+            "mode": "lines",
+            "line": {"color": plot_colors['ci_line'], "width": 2},
+            "hoverinfo": "skip",
+            "showlegend": False
+        },
+        # Puntos (valores centrales), por WebGL: un único canvas en lugar de
+        # un nodo SVG por punto
+        {
+            "type": "scattergl",
+            "x": val,
+            "y": labels,
+            "mode": "markers",
+            "marker": {"symbol": "square", "size": 10, "color": plot_colors['marker']},
+            "name": "Estudio", # Nombre para el tooltip
+            # Tooltip estático (etiqueta, valor y CI) resuelto por punto con
+            # customdata: no requiere recálculo en JS al mover el ratón
+            "customdata": np.stack([lo, hi], axis=1),
+            "hovertemplate": "%{y}<br>%{x:.2f} [%{customdata[0]:.2f}, %{customdata[1]:.2f}]<extra></extra>",
+            "showlegend": False
+        },
+        # Texto con los valores numéricos en el borde derecho del gráfico
+        {
+            "type": "scatter",
+            "x": np.full(ann_val.size, calculated_x_range_max),
+            "y": labels[::annot_step],
+            "mode": "text",
+            "text": ann_text,
+            "textposition": "middle left", # Alinea el texto a la izquierda de la posición X
+            "textfont": {"size": 11, "color": '#555555'},
+            "hoverinfo": "skip",
+            "showlegend": False
+        }
+    ]
+
+    layout = {
+        "title": {
+            "text": title,
+            "y": 0.95, # Posición del título
+            "x": 0.5,
+            "xanchor": "center",
+            "yanchor": "top"
+        },
+        "xaxis": {
+            "title": {"text": x_axis_label},
+            "range": [calculated_x_range_min, calculated_x_range_max],
+            "showgrid": True,
+            "gridcolor": "lightgray",
+            "zeroline": False
+        },
+        "yaxis": {
+            "title": {"text": ''}, # Las etiquetas de los estudios son el eje Y
+            "type": "category", # evitar la autodetección de tipo de eje
+            "categoryorder": "array",
+            "categoryarray": y_categories,
+            "automargin": True, # Asegura que las etiquetas del eje Y se muestren completamente
+            "showgrid": False
+        },
+        # Línea de referencia vertical, como shape (antes add_vline)
+        "shapes": [{
+            "type": "line",
+            "x0": ref_line_value, "x1": ref_line_value,
+            "yref": "paper", "y0": 0, "y1": 1,
+            "line": {"width": 1.5, "dash": "dash", "color": plot_colors['ref_line']}
+        }],
+        "hovermode": "closest", # Tooltip por punto: evita el barrido O(N) de "y unified"
+        "margin": {"l": 100, "r": 120, "t": 80, "b": 50}, # Márgenes para el texto y etiquetas
+        "plot_bgcolor": 'rgba(0,0,0,0)', # Fondo del área de plot transparente
+        "paper_bgcolor": 'rgba(0,0,0,0)' # Fondo del papel transparente
+    }
+
+    # Construir la figura de una sola vez: el validador del esquema de Plotly
+    # corre una vez, en lugar de en cada add_trace/add_vline/update_layout
+    return go.Figure({"data": data_list, "layout": layout})
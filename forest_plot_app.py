@@ -1,8 +1,36 @@
+import hashlib
+
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
+import plotly.io as pio
 from io import BytesIO
 
+from forest_plot import LARGE_PLOT_THRESHOLD, generate_plotly_forest_plot
+
+# --- Serialización JSON de figuras ---
+# orjson serializa los arrays NumPy en una sola pasada en C: acelera el
+# fig.to_json() que st.plotly_chart ejecuta en cada rerun. Si no está
+# instalado, plotly sigue con el json de la librería estándar.
+try:
+    pio.json.config.default_engine = "orjson"
+except ValueError:
+    pass
+
+# --- Configuración de Kaleido (exportación de imágenes) ---
+# Se fija una sola vez al importar el módulo; todas las exportaciones
+# reutilizan estos valores (y el proceso de Kaleido ya arrancado) en lugar
+# de reconfigurarlo en cada llamada.
+if hasattr(pio, "defaults"): # plotly >= 6 (Kaleido v1)
+    pio.defaults.default_format = "png"
+    pio.defaults.default_width = 1200
+    pio.defaults.default_height = 700
+    pio.defaults.default_scale = 2 # scale=2 para mayor resolución
+else: # plotly 5.x: el scope clásico mantiene vivo el Chromium de Kaleido
+    pio.kaleido.scope.default_format = "png"
+    pio.kaleido.scope.default_width = 1200
+    pio.kaleido.scope.default_height = 700
+    pio.kaleido.scope.default_scale = 2
+
 # --- Configuración de la Página de Streamlit ---
 st.set_page_config(
     page_title="Forest Plot Interactivo",
@@ -37,40 +65,179 @@ uploaded_file = st.file_uploader(
     type=["csv", "xls", "xlsx"]
 )
 
+REQUIRED_COLS = {'label', 'value', 'lower_ci', 'upper_ci'}
+NUMERIC_COLS = ['value', 'lower_ci', 'upper_ci']
+
+# Tope duro de filas: acota la memoria y la latencia ante subidas
+# accidentalmente enormes (la lectura se corta en cuanto se alcanza)
+MAX_ROWS = 100_000
+CSV_CHUNK_ROWS = 20_000
+
+# pyarrow es opcional: si está instalado, los CSV se leen con su parser
+# multihilo, proyectando solo las 4 columnas necesarias y con tipos ya fijados
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+
+def _read_csv_arrow(file_bytes: bytes) -> tuple[pd.DataFrame, bool]:
+    """
+    Lee un CSV con pyarrow en streaming: solo las columnas requeridas, con
+    las columnas numéricas ya parseadas como float64 (sin pasada posterior
+    de to_numeric), y cortando la lectura al llegar a MAX_ROWS.
+    """
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=['label', 'value', 'lower_ci', 'upper_ci'],
+        column_types={col: pa.float64() for col in NUMERIC_COLS},
+        null_values=['', 'NA', 'NaN'],
+        strings_can_be_null=True
+    )
+    batches = []
+    rows = 0
+    with pa_csv.open_csv(BytesIO(file_bytes), convert_options=convert_options) as reader:
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= MAX_ROWS:
+                break # parada temprana: no se parsea el resto del archivo
+        table = pa.Table.from_batches(batches, schema=reader.schema).slice(0, MAX_ROWS)
+    return table.to_pandas(), rows > MAX_ROWS
+
+
+def _read_csv_chunked(file_bytes: bytes) -> tuple[pd.DataFrame, bool]:
+    """
+    Lee un CSV con pandas por bloques de CSV_CHUNK_ROWS filas, parando en
+    cuanto se alcanza MAX_ROWS en lugar de parsear el archivo entero.
+    """
+    chunks = []
+    rows = 0
+    truncated = False
+    for chunk in pd.read_csv(BytesIO(file_bytes), chunksize=CSV_CHUNK_ROWS, on_bad_lines='skip'):
+        chunks.append(chunk)
+        rows += len(chunk)
+        if rows >= MAX_ROWS:
+            truncated = True
+            break
+    if not chunks:
+        return pd.read_csv(BytesIO(file_bytes), nrows=0), False
+    df = pd.concat(chunks, copy=False) if len(chunks) > 1 else chunks[0]
+    return df.iloc[:MAX_ROWS], truncated
+
+
+@st.cache_data(show_spinner=False)
+def load_and_clean(file_bytes: bytes, name: str) -> tuple[pd.DataFrame, int, bool]:
+    """
+    Lee y limpia el archivo subido. Cacheada por contenido (bytes) y nombre,
+    para no re-parsear el archivo en cada interacción con los widgets.
+
+    Args:
+        file_bytes (bytes): Contenido crudo del archivo subido.
+        name (str): Nombre del archivo (decide entre CSV y Excel).
+
+    Returns:
+        tuple: (DataFrame limpio, número de filas eliminadas por datos no
+        válidos, True si la lectura se cortó en MAX_ROWS).
+    """
+    needs_coercion = True # las rutas con tipos ya fijados la desactivan
+    truncated = False
+    if name.endswith('.csv'):
+        df = None
+        if pa is not None:
+            try:
+                df, truncated = _read_csv_arrow(file_bytes)
+                needs_coercion = False
+            except (pa.ArrowInvalid, pa.ArrowKeyError):
+                # Columnas faltantes o valores no numéricos: pandas se encarga
+                # (la validación y el coerce de abajo dan los mensajes de siempre)
+                df = None
+        if df is None:
+            df, truncated = _read_csv_chunked(file_bytes)
+    elif name.endswith('.xlsx'):
+        try:
+            # El motor calamine (Rust) parsea el XLSX mucho más rápido que el
+            # SAX en Python puro de openpyxl; usecols evita materializar
+            # columnas que no se usan
+            df = pd.read_excel(
+                BytesIO(file_bytes),
+                engine="calamine",
+                usecols=['label', 'value', 'lower_ci', 'upper_ci']
+            )
+        except (ImportError, ValueError):
+            # Sin python-calamine instalado (o columnas faltantes): openpyxl
+            df = pd.read_excel(BytesIO(file_bytes), engine="openpyxl")
+    else:
+        # .xls antiguo: dejar que pandas escoja el motor adecuado
+        df = pd.read_excel(BytesIO(file_bytes))
+
+    if len(df) > MAX_ROWS:
+        # Excel no se lee en streaming: aplicar el tope tras la lectura
+        df = df.iloc[:MAX_ROWS]
+        truncated = True
+
+    # La validación de columnas se hace fuera (con st.error); si faltan
+    # columnas devolvemos el DataFrame tal cual, sin limpiar.
+    if not REQUIRED_COLS.issubset(df.columns):
+        return df, 0, truncated
+
+    # Convertir a numérico, forzando errores a NaN
+    if needs_coercion:
+        for col in NUMERIC_COLS:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    # Eliminar filas con NaN en las columnas clave: una sola pasada con una
+    # máscara booleana, sin la copia oculta que hace dropna(inplace=True)
+    mask = df[NUMERIC_COLS].notna().all(axis=1).to_numpy()
+    dropped = int((~mask).sum())
+    if dropped:
+        df = df.loc[mask].reset_index(drop=True)
+    return df, dropped, truncated
+
+
 data_df = pd.DataFrame() # DataFrame vacío por defecto
 
 if uploaded_file is not None:
     try:
-        # Leer el archivo
-        if uploaded_file.name.endswith('.csv'):
-            data_df = pd.read_csv(uploaded_file)
-        elif uploaded_file.name.endswith(('.xls', '.xlsx')):
-            data_df = pd.read_excel(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        upload_hash = hashlib.blake2b(file_bytes).hexdigest()
+
+        if pa is not None and st.session_state.get('upload_hash') == upload_hash:
+            # Mismo archivo que en el rerun anterior: recargar el DataFrame ya
+            # limpio desde el Parquet guardado en session_state, sin re-parsear
+            data_df = pd.read_parquet(BytesIO(st.session_state['parquet_blob']))
+            dropped_rows = st.session_state['dropped_rows']
+            truncated = st.session_state['truncated']
+        else:
+            # Leer y limpiar el archivo (cacheado: solo se re-parsea si cambia)
+            data_df, dropped_rows, truncated = load_and_clean(file_bytes, uploaded_file.name)
 
         # Validar columnas
-        required_cols = {'label', 'value', 'lower_ci', 'upper_ci'}
-        if not required_cols.issubset(data_df.columns):
+        if not REQUIRED_COLS.issubset(data_df.columns):
             st.error(
                 "❌ **Error:** Faltan columnas. Asegúrate de tener `label`, `value`, `lower_ci`, `upper_ci`."
             )
             data_df = pd.DataFrame() # Vaciar si hay error
         else:
-            # Convertir a numérico, forzando errores a NaN
-            for col in ['value', 'lower_ci', 'upper_ci']:
-                data_df[col] = pd.to_numeric(data_df[col], errors='coerce')
-            
-            # Eliminar filas con NaN en las columnas clave
-            initial_rows = len(data_df)
-            data_df.dropna(subset=['value', 'lower_ci', 'upper_ci'], inplace=True)
-            if len(data_df) < initial_rows:
-                st.warning(f"⚠️ Se eliminaron {initial_rows - len(data_df)} filas con datos no válidos.")
-            
+            if truncated:
+                st.warning(f"⚠️ El archivo supera el límite de {MAX_ROWS:,} filas; solo se usaron las primeras.")
+            if dropped_rows > 0:
+                st.warning(f"⚠️ Se eliminaron {dropped_rows} filas con datos no válidos.")
+
             if data_df.empty:
                 st.error("El archivo no contiene datos válidos para el gráfico.")
             else:
                 st.success("✅ Datos cargados correctamente. Primeras 5 filas:")
                 st.dataframe(data_df.head())
 
+                if pa is not None:
+                    # Guardar el resultado limpio como Parquet (columnar y
+                    # tipado) para que los próximos reruns lo recarguen directo
+                    st.session_state['parquet_blob'] = data_df.to_parquet(compression='zstd')
+                    st.session_state['upload_hash'] = upload_hash
+                    st.session_state['dropped_rows'] = dropped_rows
+                    st.session_state['truncated'] = truncated
+
     except Exception as e:
         st.error(f"❌ Error al procesar el archivo: {e}. ¿Está dañado o es el formato correcto?")
         data_df = pd.DataFrame()
@@ -101,138 +268,67 @@ plot_colors = {
     'ref_line': ref_line_color
 }
 
-# --- Función para Generar el Forest Plot ---
-def generate_plotly_forest_plot(df, title, ref_line_value, x_axis_label, plot_colors):
-    """
-    Genera un Forest Plot interactivo usando Plotly.
-
-    Args:
-        df (pd.DataFrame): DataFrame con las columnas 'label', 'value', 'lower_ci', 'upper_ci'.
-        title (str): Título principal del gráfico.
-        ref_line_value (float): Valor para la línea de referencia (ej. 0 o 1).
-        x_axis_label (str): Etiqueta del eje X.
-        plot_colors (dict): Diccionario con colores para 'marker', 'ci_line', 'ref_line'.
 
-    Returns:
-        plotly.graph_objects.Figure: Objeto figura de Plotly.
+@st.cache_data(show_spinner=False)
+def render_image(fig_json: str, fmt: str) -> bytes:
     """
-    fig = go.Figure()
-
-    # Ordenar los estudios para que aparezcan de abajo hacia arriba en el gráfico,
-    # manteniendo el orden de entrada si no hay una columna de ordenación explícita.
-    df_sorted = df.iloc[::-1].copy() # Invertir el DataFrame para que el primer estudio esté arriba
-
-    y_labels = df_sorted['label'].tolist()
-
-    # Añadir los puntos (valores centrales) y las barras de error
-    fig.add_trace(go.Scatter(
-        x=df_sorted['value'],
-        y=y_labels,
-        mode='markers',
-        marker=dict(symbol='square', size=10, color=plot_colors['marker']),
-        error_x=dict(
-            type='data', symmetric=False,
-            array=df_sorted['upper_ci'] - df_sorted['value'],
-            arrayminus=df_sorted['value'] - df_sorted['lower_ci'],
-            visible=True, color=plot_colors['ci_line'], thickness=2, width=5 # Ancho de las "tapas" del intervalo de confianza
-        ),
-        name='Estudio', # Nombre para el tooltip
-        hoverinfo='x+y+text', # Mostrar valor, etiqueta y CI en el tooltip
-        text=[f"CI: [{lc:.2f}, {uc:.2f}]" for lc, uc in zip(df_sorted['lower_ci'], df_sorted['upper_ci'])],
-        showlegend=False
-    ))
-
-    # Añadir la línea de referencia vertical
-    fig.add_vline(x=ref_line_value, line_width=1.5, line_dash="dash", line_color=plot_colors['ref_line'])
-
-    # Personalizar el layout del gráfico
-    fig.update_layout(
-        title={
-            'text': title,
-            'y':0.95, # Posición del título
-            'x':0.5,
-            'xanchor': 'center',
-            'yanchor': 'top'
-        },
-        xaxis_title=x_axis_label,
-        yaxis_title='', # Las etiquetas de los estudios son el eje Y
-        yaxis=dict(
-            categoryorder='array',
-            categoryarray=y_labels,
-            automargin=True, # Asegura que las etiquetas del eje Y se muestren completamente
-            showgrid=False # Propiedad corregida: ahora está dentro del dict de yaxis
-        ),
-        hovermode="y unified", # Tooltip al pasar por encima de la fila completa
-        margin=dict(l=100, r=120, t=80, b=50), # Márgenes para el texto y etiquetas
-        plot_bgcolor='rgba(0,0,0,0)', # Fondo del área de plot transparente
-        paper_bgcolor='rgba(0,0,0,0)', # Fondo del papel transparente
-        xaxis=dict(showgrid=True, gridcolor='lightgray', zeroline=False)
-    )
+    Convierte la figura (serializada como JSON) a imagen con Kaleido.
+    Cacheada por JSON y formato: Kaleido solo se invoca cuando la figura
+    cambia de verdad, no en cada rerun de la app. Las dimensiones y la escala
+    salen de los valores por defecto configurados al importar el módulo.
+    """
+    return pio.from_json(fig_json).to_image(format=fmt)
 
-    # Añadir texto con los valores numéricos exactos al lado derecho del gráfico
-    # Calculamos el rango del eje X para posicionar el texto de forma adaptativa
-    x_min_data = df_sorted['lower_ci'].min()
-    x_max_data = df_sorted['upper_ci'].max()
-    
-    # Considerar también el valor de la línea de referencia para el rango
-    effective_min_x = min(x_min_data, ref_line_value)
-    effective_max_x = max(x_max_data, ref_line_value)
-
-    # Un factor de padding para dejar espacio para el texto y evitar que se salga del gráfico
-    padding_factor = 0.20 # 20% del rango de los datos para el texto
-
-    # Calcula el nuevo rango máximo del eje X para acomodar el texto
-    calculated_x_range_max = effective_max_x + (effective_max_x - effective_min_x) * padding_factor
-    calculated_x_range_min = effective_min_x - (effective_max_x - effective_min_x) * padding_factor * 0.1 # Pequeño padding a la izquierda
-
-    fig.update_xaxes(range=[calculated_x_range_min, calculated_x_range_max])
-
-    # Añadir las anotaciones de texto
-    for i, row in df_sorted.iterrows():
-        fig.add_annotation(
-            x=calculated_x_range_max, # Posiciona el texto en el borde derecho del gráfico
-            y=row['label'],
-            text=f"{row['value']:.2f} [{row['lower_ci']:.2f}, {row['upper_ci']:.2f}]",
-            showarrow=False,
-            xanchor='right', # Alinea el texto a la derecha de la posición X
-            yanchor='middle',
-            font=dict(size=11, color='#555555')
-        )
-    return fig
 
 # --- Sección de Visualización y Exportación ---
 st.header("3. Tu Forest Plot y Exportación")
 
 if not data_df.empty:
     try:
+        # Con muchos estudios, dejar ajustar cuántas anotaciones se dibujan
+        annot_step = None
+        n_rows = len(data_df)
+        if n_rows > LARGE_PLOT_THRESHOLD:
+            annot_step = st.sidebar.slider(
+                "Anotar 1 de cada k filas:",
+                min_value=1,
+                max_value=max(2, n_rows // 50),
+                value=max(1, n_rows // 200),
+                help="Con miles de estudios, menos anotaciones = gráfico más fluido."
+            )
+
         # Generar el gráfico
         fig = generate_plotly_forest_plot(
             data_df,
             title=plot_title,
             ref_line_value=ref_line_value,
             x_axis_label=x_axis_label,
-            plot_colors=plot_colors
+            plot_colors=plot_colors,
+            annot_step=annot_step
         )
         
         # Mostrar el gráfico interactivo
         st.plotly_chart(fig, use_container_width=True)
 
-        # Botones de descarga
+        # Botones de descarga (las imágenes se cachean por figura y formato,
+        # así Kaleido no se ejecuta de nuevo en cada interacción)
         st.subheader("Descargar Gráfico")
+        fig_json = fig.to_json()
+        safe_title = plot_title.replace(' ', '_') # una sola vez para ambos botones
         col_dl1, col_dl2 = st.columns(2)
         with col_dl1:
             st.download_button(
                 label="Descargar como PNG",
-                data=fig.to_image(format="png", engine="kaleido", width=1200, height=700, scale=2), # scale=2 para mayor resolución
-                file_name=f"{plot_title.replace(' ', '_')}_forest_plot.png",
+                data=render_image(fig_json, "png"),
+                file_name=f"{safe_title}_forest_plot.png",
                 mime="image/png",
                 help="Descarga el gráfico como una imagen PNG (para usar en presentaciones)."
             )
         with col_dl2:
             st.download_button(
                 label="Descargar como SVG",
-                data=fig.to_image(format="svg", engine="kaleido", width=1200, height=700, scale=2),
-                file_name=f"{plot_title.replace(' ', '_')}_forest_plot.svg",
+                data=render_image(fig_json, "svg"),
+                file_name=f"{safe_title}_forest_plot.svg",
                 mime="image/svg+xml",
                 help="Descarga el gráfico como una imagen SVG (vectorial, ideal para edición profesional)."
             )